@@ -1,48 +1,317 @@
+import concurrent.futures
 import hashlib
+import mmap
 import os
+import re
 import shutil
+import stat
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 import bvzfilesystemlib
 
 from bvzversionedfiles.copydescriptor import Copydescriptor
+from bvzversionedfiles.dedupindex import DedupIndex
+
+# MD5 constructor for the fallback hashing path. usedforsecurity=False (python 3.9+) tells OpenSSL these hashes are
+# not used as a crypto primitive, which skips the FIPS bookkeeping and - on FIPS-enabled builds - keeps MD5 from being
+# rejected outright.
+try:
+    hashlib.md5(usedforsecurity=False)
+
+    def _md5():
+        return hashlib.md5(usedforsecurity=False)
+except (TypeError, ValueError):
+    _md5 = hashlib.md5
+
+# The name of the hashing algorithm actually in use, mirroring the preference order of _content_hash. Stored in the
+# persistent dedup index so that stale digests are discarded if the available modules change.
+if blake3 is not None:
+    _HASH_NAME = "blake3"
+elif xxhash is not None:
+    _HASH_NAME = "xxh3_128"
+else:
+    _HASH_NAME = "md5"
+
+# A small, lazily created thread pool used to hash two files concurrently. Hashing releases the GIL, so the two reads
+# and hash computations genuinely overlap.
+_pair_hash_executor = None
+
+# How many bytes of the head of a file to hash when using a head hash as a cheap pre-filter before committing to a
+# full-file hash.
+_HEAD_HASH_SIZE = 65536
+
+# Files smaller than this are hashed with a single read instead of being memory mapped - below this point the cost of
+# setting up and tearing down a mapping outweighs the copy it avoids.
+_MMAP_THRESHOLD = 65536
+
+# The linux FICLONE ioctl, which asks a copy-on-write filesystem (btrfs, xfs) to reflink one file's data to another -
+# an effectively instant, zero-byte copy. None on platforms where it cannot work.
+_FICLONE = 0x40049409 if (fcntl is not None and sys.platform == "linux") else None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_pair_hash_executor():
+    """
+    Return the module-level two-worker thread pool, creating it on first use.
+
+    :return:
+            A ThreadPoolExecutor with two workers.
+    """
+
+    global _pair_hash_executor
+
+    if _pair_hash_executor is None:
+        _pair_hash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+    return _pair_hash_executor
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _new_hasher():
+    """
+    Return a new hasher object, preferring blake3, then xxh3_128, then md5 (mirroring the preference order used by
+    _content_hash).
+
+    :return:
+            A hasher object with update() and digest() methods.
+    """
+
+    if blake3 is not None:
+        return blake3.blake3()
+    if xxhash is not None:
+        return xxhash.xxh3_128()
+    return _md5()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _head_hash(file_p,
+               head_size=_HEAD_HASH_SIZE):
+    """
+    Create a content hash of only the first head_size bytes of a file. Used as a cheap filter to reject candidate
+    matches without reading whole files: two files whose head hashes differ cannot be identical.
+
+    :param file_p:
+            The path to the file we are hashing.
+    :param head_size:
+            How many bytes of the head of the file to hash. Defaults to 64 KB.
+
+    :return:
+            The hash digest of the head of the file as bytes.
+    """
+
+    with open(file_p, "rb") as f:
+        data = f.read(head_size)
+
+    hasher = _new_hasher()
+    hasher.update(data)
+
+    return hasher.digest()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _content_hash(file_p,
+                  block_size=2**22):
+    """
+    Create a content hash for a file without reading the whole file in a single chunk.
+
+    The hash is only ever used to test whether two local files hold the same bytes, so there is no cryptographic
+    requirement. If the blake3 module is available it is used (it is SIMD accelerated and multi-threaded, and avoids
+    the chunked python read loop entirely by memory mapping the file). Failing that, xxh3_128 is used if the xxhash
+    module is available. If neither module is available, falls back to md5.
+
+    :param file_p:
+            The path to the file we are hashing.
+    :param block_size:
+            How much to read in a single chunk when falling back to a chunked read. Defaults to 4 MB.
+
+    :return:
+            The hash digest as bytes.
+    """
+
+    if blake3 is not None:
+        hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        try:
+            hasher.update_mmap(file_p)
+        except AttributeError:  # blake3 older than 0.4 does not have update_mmap
+            with open(file_p, "rb") as f:
+                while True:
+                    data = f.read(block_size)
+                    if not data:
+                        break
+                    hasher.update(data)
+        return hasher.digest()
+
+    if xxhash is not None:
+        hasher_type = xxhash.xxh3_128
+    else:
+        hasher_type = _md5
+
+    with open(file_p, "rb") as f:
+
+        # Tell the kernel we are about to read the whole file front to back, so it can use a larger readahead window.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        size = os.fstat(f.fileno()).st_size
+        digest = None
+
+        # Small files are cheaper to hash from a single read than from a mapping.
+        if 0 < size < _MMAP_THRESHOLD:
+            hasher = hasher_type()
+            hasher.update(f.read())
+            digest = hasher.digest()
+
+        # Preferred path for everything else: memory map the file and hash it with a single update call. The hasher
+        # consumes the mapped pages directly via the buffer protocol, so there is no per-chunk python dispatch and no
+        # copying of kernel buffers into python bytes objects.
+        elif size > 0:
+            try:
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher = hasher_type()
+                    hasher.update(mm)
+                    digest = hasher.digest()
+            except (ValueError, OverflowError, OSError):
+                digest = None  # the file cannot be mapped (e.g. too large for a 32 bit build) - fall back to reads
+
+        if digest is None:
+            if size == 0:
+                digest = hasher_type().digest()
+            elif hasattr(hashlib, "file_digest"):
+                # hashlib.file_digest (python 3.11+) runs the whole read/update loop in C, with no per-chunk python
+                # dispatch and with the GIL released while hashing.
+                digest = hashlib.file_digest(f, hasher_type).digest()
+            else:
+                hasher = hasher_type()
+                while True:
+                    data = f.read(block_size)
+                    if not data:
+                        break
+                    hasher.update(data)
+                digest = hasher.digest()
+
+        # Hashed files are read exactly once, so drop their pages afterwards - a large dedup scan should not evict the
+        # rest of the page cache.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    return digest
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-def md5_for_file(file_p,
-                 block_size=2**20):
+def content_hash_for_file(file_p,
+                          block_size=2**22):
     """
-    Create an md5 checksum for a file without reading the whole file in a single chunk.
+    Create a content hash for a file without reading the whole file in a single chunk.
 
     :param file_p:
-            The path to the file we are check-summing.
+            The path to the file we are hashing.
     :param block_size:
-            How much to read in a single chunk. Defaults to 1 MB
+            How much to read in a single chunk. Defaults to 4 MB
 
     :return:
-            The md5 checksum.
+            The content hash digest as bytes.
     """
 
     assert type(file_p) is str
     assert type(block_size) is int
 
-    md5 = hashlib.md5()
-    with open(file_p, "rb") as f:
-        while True:
-            data = f.read(block_size)
-            if not data:
-                break
-            md5.update(data)
+    return _content_hash(file_p, block_size)
+
+
+# Old name kept as an alias for backwards compatibility. Note that the digest is only guaranteed to actually be an md5
+# digest when neither the blake3 nor xxhash modules are installed.
+md5_for_file = content_hash_for_file
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _read_range(f,
+                length,
+                offset):
+    """
+    Read a byte range from an open binary file, using os.pread where available (one syscall, does not disturb the
+    file position) and seek/read elsewhere.
+
+    :param f:
+            The open binary file to read from.
+    :param length:
+            How many bytes to read.
+    :param offset:
+            The offset to read from.
+
+    :return:
+            The bytes read.
+    """
 
-    return md5.digest()
+    if hasattr(os, "pread"):
+        return os.pread(f.fileno(), length, offset)
+
+    f.seek(offset)
+    return f.read(length)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _head_tail_equal(file_a_p,
+                     file_b_p,
+                     size,
+                     probe_size=_HEAD_HASH_SIZE):
+    """
+    Cheaply test whether two same-sized files could be identical by comparing their first and last probe_size bytes.
+    Files that differ usually differ in one of those regions, so this rejects most mismatches after two small reads
+    per file instead of a full read of both. A True result does not prove the files match - it only means the probed
+    regions match.
+
+    :param file_a_p:
+            The path to the first file being compared.
+    :param file_b_p:
+            The path to the second file being compared.
+    :param size:
+            The (shared) size of the two files.
+    :param probe_size:
+            How many bytes to compare at each end. Defaults to 64 KB.
+
+    :return:
+            False if the files provably differ, True if they still might be identical.
+    """
+
+    with open(file_a_p, "rb") as f_a, open(file_b_p, "rb") as f_b:
+
+        if _read_range(f_a, probe_size, 0) != _read_range(f_b, probe_size, 0):
+            return False
+
+        if size > probe_size:
+            offset = size - probe_size
+            if _read_range(f_a, probe_size, offset) != _read_range(f_b, probe_size, offset):
+                return False
+
+    return True
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 def files_are_identical(file_a_p,
                         file_b_p,
-                        block_size=2**20):
+                        block_size=2**22,
+                        use_hashes=False):
     """
-    Compares two files to see if they are identical. First compares sizes. If the sizes match, then it does an md5
-    checksum on the files to see if they match. Ignores all metadata when comparing (name, creation or modification
+    Compares two files to see if they are identical. First compares sizes. If the sizes match, the file contents are
+    compared directly byte for byte - unlike hashing both files in full, a direct comparison stops at the first
+    differing byte and never pays any hashing CPU. Ignores all metadata when comparing (name, creation or modification
     dates, etc.) Returns True if they match, False otherwise.
 
     :param file_a_p:
@@ -50,7 +319,11 @@ def files_are_identical(file_a_p,
     :param file_b_p:
             The path to the second file we are comparing
     :param block_size:
-            How much to read in a single chunk when doing the md5 checksum. Defaults to 1 MB
+            How much to read in a single chunk when hashing (only used when use_hashes is True). Defaults to 4 MB
+    :param use_hashes:
+            If True, compare the files by computing and comparing their full content hashes (both files hashed
+            concurrently) instead of comparing bytes directly. Only worthwhile if the caller also wants the hashes
+            warmed into any external cache. Defaults to False.
 
     :return:
             True if the files match, False otherwise.
@@ -60,26 +333,256 @@ def files_are_identical(file_a_p,
     assert type(file_b_p) is str
     assert type(block_size) is int
 
-    if os.path.getsize(file_a_p) == os.path.getsize(file_b_p):
-        md5_a = md5_for_file(file_a_p, block_size)
-        md5_b = md5_for_file(file_b_p, block_size)
-        return md5_a == md5_b
+    stat_a = os.stat(file_a_p)
+    stat_b = os.stat(file_b_p)
+
+    # If both paths resolve to the same inode (hardlinks, or the same file given twice) they are identical by
+    # definition and there is no need to read either file.
+    if (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino):
+        return True
+
+    if stat_a.st_size == stat_b.st_size:
+
+        # Same-sized files that differ usually differ in their first or last few KB - check those cheaply before
+        # committing to reading both files in full.
+        if not _head_tail_equal(file_a_p, file_b_p, stat_a.st_size):
+            return False
+
+        if not use_hashes:
+            return _byte_equal(file_a_p, file_b_p)
+
+        executor = _get_pair_hash_executor()
+        future_a = executor.submit(content_hash_for_file, file_a_p, block_size)
+        future_b = executor.submit(content_hash_for_file, file_b_p, block_size)
+        return future_a.result() == future_b.result()
 
     return False
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def _atomic_symlink(target,
+                    dest_p):
+    """
+    Create (or replace) a symlink atomically. The link is created under a temporary name in the same directory and
+    renamed into place with os.replace, so there is never a moment where dest_p is missing or half-made, and no
+    check-then-unlink race with other writers.
+
+    :param target:
+            The path the symlink will point to.
+    :param dest_p:
+            The path of the symlink itself.
+
+    :return:
+            Nothing.
+    """
+
+    temp_p = dest_p + f".tmp.{os.getpid()}"
+    os.symlink(target, temp_p)
+
+    try:
+        os.replace(temp_p, dest_p)
+    except OSError:
+        os.unlink(temp_p)
+        raise
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _byte_equal(file_a_p,
+                file_b_p):
+    """
+    Compare two files byte for byte, reading each file only once. This is strictly cheaper than hashing both files:
+    no hash is computed at all, and the comparison stops at the first difference. Both files are memory mapped where
+    possible, so the compare runs at C speed over demand-paged memory; otherwise a chunked read loop is used.
+
+    :param file_a_p:
+            The path to the first file being compared.
+    :param file_b_p:
+            The path to the second file being compared.
+
+    :return:
+            True if the files hold identical bytes, False otherwise.
+    """
+
+    with open(file_a_p, "rb") as f_a, open(file_b_p, "rb") as f_b:
+
+        stat_a = os.fstat(f_a.fileno())
+        stat_b = os.fstat(f_b.fileno())
+
+        if (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino):
+            return True
+
+        if stat_a.st_size != stat_b.st_size:
+            return False
+
+        if stat_a.st_size == 0:
+            return True
+
+        try:
+            with mmap.mmap(f_a.fileno(), stat_a.st_size, access=mmap.ACCESS_READ) as mm_a, \
+                    mmap.mmap(f_b.fileno(), stat_b.st_size, access=mmap.ACCESS_READ) as mm_b:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm_a.madvise(mmap.MADV_SEQUENTIAL)
+                    mm_b.madvise(mmap.MADV_SEQUENTIAL)
+                # memoryview equality compares the underlying buffers directly, without copying either mapping.
+                return memoryview(mm_a) == memoryview(mm_b)
+        except (ValueError, OverflowError, OSError):
+            pass  # the files cannot be mapped - fall back to chunked reads
+
+        # Preallocated buffers with readinto avoid allocating a fresh bytes object per chunk, and comparing memoryview
+        # slices is a single C-level compare per chunk - no python bytecode runs per byte.
+        buffer_a = bytearray(2**22)
+        buffer_b = bytearray(2**22)
+        view_a = memoryview(buffer_a)
+        view_b = memoryview(buffer_b)
+
+        while True:
+            read_a = f_a.readinto(buffer_a)
+            read_b = f_b.readinto(buffer_b)
+            if read_a != read_b or view_a[:read_a] != view_b[:read_b]:
+                return False
+            if read_a == 0:
+                return True
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _fast_copy(src,
+               dst):
+    """
+    Copy a file, preferring in-kernel mechanisms over a userspace read/write loop. Tries, in order: the FICLONE ioctl
+    (an effectively instant copy-on-write reflink on btrfs/xfs), os.copy_file_range (in-kernel copy on Linux 4.5+,
+    which may also reflink), os.sendfile, and finally a plain userspace copy. Each mechanism falls through to the
+    next when it is unavailable or unsupported for these particular paths (e.g. the files live on different
+    filesystems). File permissions are preserved, as they were with shutil.copy. Other metadata (timestamps etc.) is
+    not.
+
+    :param src:
+            The source file to be copied.
+    :param dst:
+            The destination file name where the file will be copied.
+
+    :return:
+            Nothing.
+    """
+
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        _fast_copy_fileobj(f_src, f_dst)
+
+    shutil.copymode(src, dst)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _fast_copy_fileobj(f_src,
+                       f_dst):
+    """
+    Copy the contents of one already-open binary file into another, using the same in-kernel ladder as _fast_copy
+    (FICLONE, copy_file_range, sendfile, then a userspace copy). Taking open files lets a caller that has already
+    claimed the destination (e.g. with an exclusive create) copy straight into that descriptor instead of closing and
+    re-opening the path.
+
+    :param f_src:
+            The open binary source file.
+    :param f_dst:
+            The open binary (writable) destination file.
+
+    :return:
+            Nothing.
+    """
+
+    src_fd = f_src.fileno()
+    dst_fd = f_dst.fileno()
+    size = os.fstat(src_fd).st_size
+
+    if _FICLONE is not None:
+        try:
+            fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+            return
+        except OSError:  # not a CoW filesystem, or src and dst are on different filesystems
+            pass
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            copied = 0
+            while copied < size:
+                count = os.copy_file_range(src_fd, dst_fd, size - copied)
+                if count == 0:
+                    break
+                copied += count
+            if copied >= size:
+                return
+        except OSError:  # EXDEV, ENOSYS, etc. - fall through to the next mechanism
+            pass
+        f_src.seek(0)
+        f_dst.seek(0)
+        f_dst.truncate()
+
+    if hasattr(os, "sendfile"):
+        try:
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            if offset >= size:
+                return
+        except OSError:  # sendfile to a regular file is not supported everywhere - fall through
+            pass
+        f_src.seek(0)
+        f_dst.seek(0)
+        f_dst.truncate()
+
+    shutil.copyfileobj(f_src, f_dst, 2**22)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _copy_and_hash(src,
+                   dst):
+    """
+    Copy a file while hashing the source bytes as they stream through, so a single read of the source serves both the
+    copy and the hash. File permissions are preserved, as they are by _fast_copy.
+
+    :param src:
+            The source file to be copied.
+    :param dst:
+            The destination file name where the file will be copied.
+
+    :return:
+            The content hash digest of the source as bytes.
+    """
+
+    hasher = _new_hasher()
+
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        while True:
+            data = f_src.read(2**22)
+            if not data:
+                break
+            hasher.update(data)
+            f_dst.write(data)
+
+    shutil.copymode(src, dst)
+
+    return hasher.digest()
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def verified_copy_file(src,
-                       dst):
+                       dst,
+                       src_digest=None):
     """
     Given a source file and a destination, copies the file, and then checksum's both files to ensure that the copy
-    matches the source. Raises an error if the copied file's md5 checksum does not match the source file's md5 checksum.
+    matches the source. Raises an error if the copied file's content hash does not match the source file's content
+    hash.
 
     :param src:
             The source file to be copied.
     :param dst:
             The destination file name where the file will be copied. If the destination file already exists, an error
             will be raised. You must supply the destination file name, not just the destination dir.
+    :param src_digest:
+            The content hash of the source file, if the caller has already computed it (the dedup path hashes the
+            source anyway for its duplicate lookup). When provided, only the destination is hashed here, saving a full
+            read and hash of the source. If None, both files are hashed. Defaults to None.
 
     :return:
             Nothing.
@@ -88,19 +591,80 @@ def verified_copy_file(src,
     assert type(src) is str
     assert type(dst) is str
 
-    shutil.copy(src, dst)
+    if src_digest is None:
+        # With no pre-computed digest, hash the source inline while copying it - one read of the source then serves
+        # both the copy and the verification, instead of copying first and re-reading the source to hash it.
+        src_digest = _copy_and_hash(src, dst)
+    else:
+        _fast_copy(src, dst)
+
+    # Force the copied data out to the device before re-reading the destination, so the verification below checks
+    # what landed on disk rather than the still-dirty page cache. Done here so both copy branches are covered.
+    if hasattr(os, "fdatasync"):
+        with open(dst, "rb") as f_dst:
+            os.fdatasync(f_dst.fileno())
 
-    if not files_are_identical(src, dst):
-        msg = "Verification of copy failed (md5 checksums to not match): "
+    if content_hash_for_file(dst) != src_digest:
+        msg = "Verification of copy failed (content hashes do not match): "
         raise IOError(msg + src + " --> " + dst)
 
 
+# ----------------------------------------------------------------------------------------------------------------------
+def _max_existing_version(dest_d,
+                          base,
+                          ext,
+                          ver_prefix):
+    """
+    Find the highest version number already used by files named <base>.<ver_prefix><version><ext> in the given
+    directory, using a single os.scandir pass instead of probing one candidate file name at a time.
+
+    :param dest_d:
+            The directory being searched.
+    :param base:
+            The base name of the file (without the version number or extension).
+    :param ext:
+            The file extension (including the leading dot, or "" if there is none).
+    :param ver_prefix:
+            The prefix that appears before the version number.
+
+    :return:
+            The highest existing version number, or 0 if there are none.
+    """
+
+    # Match any run of digits rather than exactly num_digits, so versions written with a different padding setting
+    # (e.g. after num_digits was changed) are still counted.
+    pattern = re.compile(re.escape(base)
+                         + r"\."
+                         + re.escape(ver_prefix)
+                         + r"(\d+)"
+                         + re.escape(ext)
+                         + r"$")
+
+    max_v = 0
+
+    try:
+        scan = os.scandir(dest_d)
+    except FileNotFoundError:
+        return 0
+
+    with scan:
+        for entry in scan:
+            match = pattern.match(entry.name)
+            if match:
+                max_v = max(max_v, int(match.group(1)))
+
+    return max_v
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 def copy_and_add_ver_num(source_p,
                          dest_p,
                          ver_prefix="v",
                          num_digits=4,
-                         do_verified_copy=False):
+                         do_verified_copy=False,
+                         src_digest=None,
+                         start_v=1,
+                         allow_hardlink=False):
     """
     Copies a source file to the dest dir, adding a version number to the file right before the extension. If a file with
     that version number already exists, the file being copied will have its version number incremented so as not to
@@ -118,6 +682,19 @@ def copy_and_add_ver_num(source_p,
             would lead to versions like: v001. Defaults to 4.
     :param do_verified_copy:
             If True, then a verified copy will be performed. Defaults to False.
+    :param src_digest:
+            The content hash of the source file, if the caller has already computed it. Only used when
+            do_verified_copy is True - it saves re-hashing the source during verification. Defaults to None.
+    :param start_v:
+            The version number to start probing at. Callers that copy many files with the same base name can remember
+            the last version they used and pass start_v to skip both the directory scan and the re-probing of already
+            taken slots. Defaults to 1, which triggers a directory scan to find the highest existing version.
+    :param allow_hardlink:
+            If True and the source file lives on the same filesystem as the destination directory, the versioned file
+            is created as a hardlink to the source instead of a byte copy - zero bytes copied, one metadata operation.
+            Note that the resulting file then shares its inode with the source: a later in-place edit of the source
+            would also change the stored file. Verification is skipped for hardlinks (there is nothing to compare -
+            both names point at the same data). Defaults to False.
 
     :return:
             A full path to the file that was copied.
@@ -128,24 +705,64 @@ def copy_and_add_ver_num(source_p,
     assert type(ver_prefix) is str
     assert type(num_digits) is int
     assert type(do_verified_copy) is bool
+    assert type(start_v) is int
 
     dest_d, dest_n = os.path.split(dest_p)
     base, ext = os.path.splitext(dest_n)
 
-    v = 1
+    # Start just past the highest existing version (found with a single directory scan) instead of stat-probing every
+    # version number from 1. Callers that already know where to start (via start_v) skip the scan entirely. The while
+    # loop below is kept as a safety net against races with other writers.
+    if start_v > 1:
+        v = start_v
+    else:
+        v = _max_existing_version(dest_d, base, ext, ver_prefix) + 1
+
+    # Local aliases so the probe loop (which can run many iterations when racing other writers) pays no
+    # LOAD_GLOBAL/LOAD_ATTR cost per iteration - the same pattern the stdlib uses in shutil.
+    # Hardlinking only works within a single filesystem, so fall back to copying when the devices differ.
+    hardlink = False
+    if allow_hardlink:
+        try:
+            hardlink = os.stat(source_p).st_dev == os.stat(dest_d).st_dev
+        except OSError:
+            hardlink = False
+
+    join = os.path.join
+    open_ = os.open
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+
+    # Build the versioned file name from a single precomputed template instead of concatenating prefix, padded number
+    # and extension anew on every probe iteration.
+    name_fmt = f"{base}.{ver_prefix}{{:0{num_digits}d}}{ext}".format
+
     while True:
 
-        version = "." + ver_prefix + str(v).rjust(num_digits, "0")
-        dest_p = os.path.join(dest_d, base + version + ext)
+        dest_p = join(dest_d, name_fmt(v))
 
-        if os.path.exists(dest_p):
+        if hardlink:
+            try:  # os.link claims the slot just as atomically as O_EXCL - it fails if the name already exists.
+                os.link(source_p, dest_p)
+            except FileExistsError:
+                v += 1
+                continue
+            return dest_p
+
+        try:  # Atomically claim this version slot - the existence check and the create are a single syscall, so a
+              # concurrent writer can never grab the same slot between a check and a copy.
+            fd = open_(dest_p, flags, 0o644)
+        except FileExistsError:
             v += 1
             continue
 
         if do_verified_copy:
-            verified_copy_file(source_p, dest_p)
+            os.close(fd)
+            verified_copy_file(source_p, dest_p, src_digest=src_digest)
         else:
-            shutil.copy(source_p, dest_p)
+            # Copy straight into the claimed descriptor rather than closing it and re-opening the path.
+            with open(source_p, "rb") as f_src, os.fdopen(fd, "wb") as f_dst:
+                _fast_copy_fileobj(f_src, f_dst)
+            shutil.copymode(source_p, dest_p)
 
         return dest_p
 
@@ -205,19 +822,14 @@ def file_list_to_copydescriptors(items,
             A list of copydescriptor objects.
     """
 
-    copydescriptors = list()
-
     if relative_d is None:
         relative_d = ""
 
-    for item in items:
-        dest_relative_p = os.path.join(relative_d, os.path.split(item)[1])
-        copydescriptor = Copydescriptor(source_p=item,
-                                        dest_relative_p=dest_relative_p,
-                                        link_in_place=link_in_place)
-        copydescriptors.append(copydescriptor)
+    join = os.path.join
+    basename = os.path.basename
+    rel_paths = [join(relative_d, basename(item)) for item in items]
 
-    return copydescriptors
+    return Copydescriptor.from_paths(items, rel_paths, link_in_place)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -235,21 +847,275 @@ def directory_to_copydescriptors(dir_d,
             A list of copydescriptor objects.
     """
 
-    copydescriptors = list()
+    # The relative path of every file is just the source path with the root directory (and its trailing separator)
+    # sliced off, so compute the slice point once instead of splitting each path.
+    prefix_len = len(dir_d.rstrip(os.sep))
 
-    for path, currentDirectory, files_n in os.walk(dir_d):
-        for file_n in files_n:
-            source_p = os.path.join(path, file_n)
-            dest_relative_p = source_p.split(dir_d)[1]
-            try:
-                copydescriptor = Copydescriptor(source_p=source_p,
-                                                dest_relative_p=dest_relative_p,
-                                                link_in_place=link_in_place)
-            except ValueError as e:
-                raise SquirrelError(str(e), 5000)
-            copydescriptors.append(copydescriptor)
+    # A recursive scandir walk yields paths straight from the DirEntry objects - unlike os.walk it builds no
+    # intermediate name lists and needs no os.path.join per file, and the is_file check reuses the stat data the
+    # scandir call already fetched.
+    def _walk(d):
+        with os.scandir(d) as scan:
+            for dir_entry in scan:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    yield from _walk(dir_entry.path)
+                elif dir_entry.is_file():
+                    yield dir_entry.path
 
-    return copydescriptors
+    sources = list(_walk(dir_d))
+    rel_paths = [source_p[prefix_len:] for source_p in sources]
+
+    return Copydescriptor.from_paths(sources, rel_paths, link_in_place)
+
+
+# In-process cache of DedupIndex instances keyed on data directory, so repeated dedup calls in one process reuse the
+# already loaded (and already refreshed) index instead of re-reading the saved index file every time.
+_dedup_index_cache = dict()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_dedup_index(data_d):
+    """
+    Return a refreshed DedupIndex for the given data directory, reusing the instance from an earlier call in this
+    process when there is one. Refreshing an up-to-date index is a no-op (it checks the directory mtime first), so a
+    tight loop of dedup calls over the same data directory stops paying any per-call scan cost.
+
+    :param data_d:
+            The data directory whose index is wanted.
+
+    :return:
+            A refreshed DedupIndex instance.
+    """
+
+    key = os.path.abspath(data_d)
+    index = _dedup_index_cache.get(key)
+
+    if index is None:
+        index = DedupIndex(data_d, algorithm=_HASH_NAME)
+        _dedup_index_cache[key] = index
+
+    index.refresh()
+
+    return index
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _stat_regular_file(file_p):
+    """
+    Stat a path, returning the stat result only if the path is a regular file. A single os.stat call answers both
+    "does it exist" and "is it a file" and also yields the size, so callers never need to stat the same inode twice.
+
+    :param file_p:
+            The path being statted.
+
+    :return:
+            The os.stat result if the path is a regular file, None if it is missing or some other type.
+    """
+
+    try:
+        st = os.stat(file_p)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    if not stat.S_ISREG(st.st_mode):
+        return None
+
+    return st
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _stat_is_file(file_p):
+    """
+    Test whether a path exists and is a regular file using a single os.stat call.
+
+    :param file_p:
+            The path being tested.
+
+    :return:
+            True if the path is a regular file, False if it is missing or some other type.
+    """
+
+    return _stat_regular_file(file_p) is not None
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _validate_sources(copydescriptors):
+    """
+    Check that every source file in the given copydescriptors exists and is a regular file, and collect their sizes.
+    Sources are grouped by parent directory and each parent is read with a single os.scandir pass, so validating N
+    sources costs one directory read per unique parent instead of one or two stat syscalls per source. All invalid
+    sources are reported in a single error instead of failing on the first one.
+
+    :param copydescriptors:
+            A list of copydescriptor objects whose sources are to be validated.
+
+    :return:
+            A dictionary where the key is a source path, and the value is the size of that file.
+    """
+
+    by_parent = dict()
+    for copydescriptor in copydescriptors:
+        parent_d, name = os.path.split(copydescriptor.source_p)
+        by_parent.setdefault(parent_d, dict()).setdefault(name, list()).append(copydescriptor.source_p)
+
+    source_sizes = dict()
+    invalid = list()
+
+    for parent_d, names in by_parent.items():
+
+        try:
+            # A CWD-relative source like "file.txt" splits to an empty parent, which scandir would reject - read the
+            # current directory in that case, matching what a stat of the bare name would have checked.
+            scan = os.scandir(parent_d or ".")
+        except (FileNotFoundError, NotADirectoryError):
+            for paths in names.values():
+                invalid.extend(paths)
+            continue
+
+        found_sizes = dict()
+        with scan:
+            for entry in scan:
+                if entry.name in names and entry.is_file():
+                    found_sizes[entry.name] = entry.stat().st_size
+
+        for name, paths in names.items():
+            if name in found_sizes:
+                for source_p in paths:
+                    source_sizes[source_p] = found_sizes[name]
+            else:
+                invalid.extend(paths)
+
+    if invalid:
+        raise ValueError("CopyDeduplicated failed: source files do not exist or are not files: "
+                         + ", ".join(sorted(invalid)))
+
+    return source_sizes
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _get_cached_hash(cache,
+                     file_p,
+                     hash_func):
+    """
+    Return the cached digest of a file, computing and caching it first if it is not already in the cache.
+
+    :param cache:
+            The dictionary of cached digests, keyed on file path.
+    :param file_p:
+            The path to the file being hashed.
+    :param hash_func:
+            The hashing function to call on a cache miss (either content_hash_for_file or _head_hash).
+
+    :return:
+            The digest as bytes.
+    """
+
+    digest = cache.get(file_p)
+
+    if digest is None:
+        digest = hash_func(file_p)
+        cache[file_p] = digest
+
+    return digest
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _hash_files_threaded(files_p,
+                         cache,
+                         hash_func):
+    """
+    Hash the given files on a thread pool, storing the digests in the given cache keyed on file path. Files already
+    present in the cache are skipped. Hashing releases the GIL, so the reads and hash computations overlap instead of
+    running one file at a time.
+
+    :param files_p:
+            An iterable of file paths to hash.
+    :param cache:
+            The dictionary of cached digests to populate, keyed on file path.
+    :param hash_func:
+            The hashing function to call per file (either content_hash_for_file or _head_hash).
+
+    :return:
+            Nothing.
+    """
+
+    to_hash = sorted(set(files_p).difference(cache))
+
+    if not to_hash:
+        return
+
+    max_workers = min(32, (os.cpu_count() or 4) * 2, len(to_hash))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for file_p, digest in zip(to_hash, executor.map(hash_func, to_hash)):
+            cache[file_p] = digest
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+def _prehash_files(copydescriptors,
+                   source_sizes,
+                   data_sizes,
+                   cached_hash,
+                   cached_head):
+    """
+    Pre-compute hashes for every source file that could possibly match an existing file in the data directory (i.e.
+    any source whose size collides with a file already stored there), plus the colliding data directory files
+    themselves. Works as a two stage ladder: first only the heads of the colliding files are hashed (cheap), then the
+    files that still collide on (size, head hash) are fully hashed. Both stages run on a thread pool. Results are
+    stored in cached_head and cached_hash, keyed on the file path.
+
+    :param copydescriptors:
+            A list of copydescriptor objects that are about to be copied.
+    :param source_sizes:
+            A dictionary of the already-statted source file sizes, keyed on source path.
+    :param data_sizes:
+            A dictionary that lists the contents of the data directory keyed by file size.
+    :param cached_hash:
+            The dictionary of cached full-file hashes to populate, keyed on file path.
+    :param cached_head:
+            The dictionary of cached head hashes to populate, keyed on file path.
+
+    :return:
+            Nothing.
+    """
+
+    collision_groups = list()
+
+    for copydescriptor in copydescriptors:
+        if copydescriptor.link_in_place:
+            continue
+        size = source_sizes[copydescriptor.source_p]
+        possible_matches_p = data_sizes.get(size)
+        if possible_matches_p:
+            collision_groups.append((size, copydescriptor.source_p, list(possible_matches_p)))
+
+    if not collision_groups:
+        return
+
+    # Stage 1: hash just the heads of every file involved in a size collision. Files smaller than the head size are
+    # skipped (their head hash would read the whole file anyway, so they go straight to the full hash stage).
+    head_files = set()
+    for size, source_p, possible_matches_p in collision_groups:
+        if size > _HEAD_HASH_SIZE:
+            head_files.add(source_p)
+            head_files.update(possible_matches_p)
+
+    _hash_files_threaded(head_files, cached_head, _head_hash)
+
+    # Stage 2: fully hash only the files that still collide after comparing head hashes.
+    full_files = set()
+    for size, source_p, possible_matches_p in collision_groups:
+        if size > _HEAD_HASH_SIZE:
+            matches = [p for p in possible_matches_p if cached_head[p] == cached_head[source_p]]
+            if not matches:
+                continue
+            full_files.add(source_p)
+            full_files.update(matches)
+        else:
+            full_files.add(source_p)
+            full_files.update(possible_matches_p)
+
+    _hash_files_threaded(full_files, cached_hash, content_hash_for_file)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -258,7 +1124,8 @@ def copy_files_deduplicated(copydescriptors,
                             data_d,
                             ver_prefix="v",
                             num_digits=4,
-                            do_verified_copy=False):
+                            do_verified_copy=False,
+                            allow_hardlink=False):
     """
     Given a list of copydescriptor objects, copy the files they represent into the data directory and make a symlink in
     dest_p that points to these files. Does de-duplication so that if more than one file (regardless of when copied or
@@ -321,6 +1188,11 @@ def copy_files_deduplicated(copydescriptors,
             would lead to versions like: v001. Defaults to 4.
     :param do_verified_copy:
             If True, then a verified copy will be performed. Defaults to False.
+    :param allow_hardlink:
+            If True, source files that live on the same filesystem as data_d are hardlinked into the data directory
+            instead of being byte-copied. This makes storing such files nearly free, but the stored file then shares
+            its data with the source - a later in-place edit of the source would also change the stored file. Defaults
+            to False.
 
     :return:
             A dictionary where the key is the source file that was copied, and the value is a string representing the
@@ -333,40 +1205,92 @@ def copy_files_deduplicated(copydescriptors,
     assert type(ver_prefix) is str
     assert type(num_digits) is int
     assert type(do_verified_copy) is bool
+    assert type(allow_hardlink) is bool
 
     if dest_d.startswith(data_d):
         raise ValueError("Destination directory may not be a child of the data directory")
 
-    for copydescriptor in copydescriptors:
-
-        if not os.path.exists(copydescriptor.source_p):
-            raise ValueError(f"CopyDeduplicated failed: source file does not exist: {source_p}")
-        if not os.path.isfile(copydescriptor.source_p):
-            raise ValueError(f"CopyDeduplicated failed: source file is not a file: {source_p}")
+    # Validates every source with one directory read per unique parent, and yields the sizes for the pre-hash pass
+    # and the copy loop below as a side effect.
+    source_sizes = _validate_sources(copydescriptors)
 
     output = dict()
 
-    data_sizes = bvzfilesystemlib.dir_files_keyed_by_size(data_d)
-    cached_md5 = dict()  # cache each md5 checksum to avoid potentially re-doing the checksum multiple times in the loop
+    # The persistent index replaces a full re-scan and re-hash of data_d: files whose (size, mtime) are unchanged since
+    # the last run reuse their stored digests. The index instance itself is also reused within this process.
+    index = _get_dedup_index(data_d)
+
+    data_sizes = index.sizes()
+    cached_hash = index.digests()  # cache each hash to avoid potentially re-doing the checksum multiple times
+    cached_head = index.head_digests()  # cache of head hashes, used to cheaply reject candidates before a full hash
+    next_ver = dict()  # remembers the next free version number per (base, ext) so repeat names don't re-scan data_d
+    by_digest = index.digest_paths()  # digest -> data file path, for O(1) duplicate lookups once a hash is known
+
+    _prehash_files(copydescriptors, source_sizes, data_sizes, cached_hash, cached_head)
+
+    # Open the destination root once so the symlink syscalls can resolve names relative to it (dir_fd) instead of
+    # walking the full destination path from / for every file. Falls back to full paths where dir_fd is unsupported.
+    dest_d = dest_d.rstrip(os.sep)
+    dest_dir_fd = None
+    # os.replace's dir_fd capability is tracked under os.rename in os.supports_dir_fd (os.replace itself is never in
+    # the set), and the atomic-rename dance below needs all three of symlink, unlink and rename.
+    if (os.symlink in os.supports_dir_fd
+            and os.unlink in os.supports_dir_fd
+            and os.rename in os.supports_dir_fd):
+        os.makedirs(dest_d, exist_ok=True)
+        try:
+            dest_dir_fd = os.open(dest_d, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        except OSError:
+            dest_dir_fd = None
 
-    for copydescriptor in copydescriptors:
+    try:
 
-        dest_p = os.path.join(dest_d, copydescriptor.dest_relative_p.lstrip(os.sep))
-
-        if not copydescriptor.link_in_place:
-            output[copydescriptor.source_p] = copy_file_deduplicated(source_p=copydescriptor.source_p,
-                                                                     dest_p=dest_p,
-                                                                     data_d=data_d,
-                                                                     data_sizes=data_sizes,
-                                                                     cached_md5=cached_md5,
-                                                                     ver_prefix=ver_prefix,
-                                                                     num_digits=num_digits,
-                                                                     do_verified_copy=do_verified_copy)
-        else:
-            os.makedirs(os.path.split(dest_p)[0], exist_ok=True)
-            if os.path.exists(dest_p):
-                os.unlink(dest_p)
-            os.symlink(copydescriptor.source_p, dest_p)
+        for copydescriptor in copydescriptors:
+
+            dest_relative_p = copydescriptor.dest_relative_p.lstrip(os.sep)
+            dest_p = os.path.join(dest_d, dest_relative_p)
+
+            if not copydescriptor.link_in_place:
+                output[copydescriptor.source_p] = copy_file_deduplicated(source_p=copydescriptor.source_p,
+                                                                         dest_p=dest_p,
+                                                                         data_d=data_d,
+                                                                         data_sizes=data_sizes,
+                                                                         cached_hash=cached_hash,
+                                                                         cached_head=cached_head,
+                                                                         source_size=source_sizes[
+                                                                             copydescriptor.source_p],
+                                                                         next_ver=next_ver,
+                                                                         by_digest=by_digest,
+                                                                         ver_prefix=ver_prefix,
+                                                                         num_digits=num_digits,
+                                                                         do_verified_copy=do_verified_copy,
+                                                                         allow_hardlink=allow_hardlink)
+            else:
+                os.makedirs(os.path.dirname(dest_p), exist_ok=True)
+                if dest_dir_fd is not None:
+                    # Same atomic create-and-rename dance as _atomic_symlink, but relative to the held directory fd:
+                    # two syscalls, no unlink, and no window where the link is missing or half-made.
+                    temp_relative_p = dest_relative_p + f".tmp.{os.getpid()}"
+                    os.symlink(copydescriptor.source_p, temp_relative_p, dir_fd=dest_dir_fd)
+                    try:
+                        os.replace(temp_relative_p, dest_relative_p,
+                                   src_dir_fd=dest_dir_fd,
+                                   dst_dir_fd=dest_dir_fd)
+                    except OSError:
+                        os.unlink(temp_relative_p, dir_fd=dest_dir_fd)
+                        raise
+                else:
+                    _atomic_symlink(copydescriptor.source_p, dest_p)
+
+    finally:
+        if dest_dir_fd is not None:
+            os.close(dest_dir_fd)
+
+    # Record everything we learned (new data files and freshly computed digests) so the next run can skip the work.
+    for source_p, data_file_p in output.items():
+        index.add_file(data_file_p, digest=cached_hash.get(source_p))
+    index.update_from_caches(cached_hash, cached_head)
+    index.save()
 
     return output
 
@@ -377,10 +1301,15 @@ def copy_file_deduplicated(source_p,
                            dest_p,
                            data_d,
                            data_sizes,
-                           cached_md5,
+                           cached_hash,
                            ver_prefix="v",
                            num_digits=4,
-                           do_verified_copy=False):
+                           do_verified_copy=False,
+                           cached_head=None,
+                           source_size=None,
+                           next_ver=None,
+                           by_digest=None,
+                           allow_hardlink=False):
     """
     Given a full path to a source file, copy that file into the data directory and make a symlink in dest_p that points
     to this file. Does de-duplication so that if more than one file contains the same data (regardless of name or any
@@ -397,10 +1326,10 @@ def copy_file_deduplicated(source_p,
     :param data_sizes:
             A dictionary that lists the contents of the data directory keyed by file size. The key is the size of the
             file, and the value is a list of files in the data directory that match this size.
-    :param cached_md5:
-            A dictionary that will be used to store cached md5 hashes to speed up the copy operation in cases where this
-            function is called more than once. This may be an empty dictionary. It is populated by repeated runs of this
-            function.
+    :param cached_hash:
+            A dictionary that will be used to store cached content hashes to speed up the copy operation in cases where
+            this function is called more than once. This may be an empty dictionary. It is populated by repeated runs
+            of this function.
     :param ver_prefix:
             The prefix to put onto the version number used inside the data_d dir to de-duplicate files. This version
             number is NOT added to the symlink file so, as far as the end user is concerned, the version number does not
@@ -411,71 +1340,134 @@ def copy_file_deduplicated(source_p,
             would lead to versions like: v001. Defaults to 4.
     :param do_verified_copy:
             If True, then a verified copy will be performed. Defaults to False.
+    :param cached_head:
+            An optional dictionary that will be used to store cached head hashes (hashes of only the first 64 KB of a
+            file). These are used to cheaply reject candidate matches before committing to a full-file hash. If None,
+            a fresh dictionary will be used. Defaults to None.
+    :param source_size:
+            The size of the source file, if the caller has already statted it. If None, the size will be looked up
+            here. Defaults to None.
+    :param next_ver:
+            An optional dictionary keyed on (base name, extension) that remembers the next free version number in the
+            data directory for that name. Used when this function is called in a loop, so that repeated copies with
+            the same destination name do not re-scan the data directory or re-probe already taken version slots. If
+            None, every call scans. Defaults to None.
+    :param by_digest:
+            An optional dictionary mapping known full-file digests to data directory paths. When the source's digest
+            is already cached, a duplicate is found with a single dictionary lookup instead of working through the
+            same-size candidates. Matches and newly copied files are added to it as they are discovered. If None, only
+            the candidate loop is used. Defaults to None.
+    :param allow_hardlink:
+            If True, hardlink the source into the data directory instead of copying when both are on the same
+            filesystem. See copy_files_deduplicated for the caveats. Defaults to False.
 
     :return:
             The string representing the path to the actual de-duplicated file in data_d.
     """
 
-    assert type(dest_p) is str
-    assert type(data_d) is str
-    assert type(source_p) is str
-    assert type(ver_prefix) is str
-    assert type(num_digits) is int
-    assert type(do_verified_copy) is bool
+    # No per-argument type asserts here: this function runs once per file in batch workloads, and the batch entry
+    # point (copy_files_deduplicated) has already validated its inputs.
 
     if dest_p.startswith(data_d):
         raise ValueError("Destination file may not be a child of the data directory")
 
-    if not os.path.isfile(source_p):
-        raise ValueError(f"copy_file_deduplicated failed: source file is not a file or does not exist: {source_p}")
+    # A single stat both validates the source and yields its size. Skipped entirely when the caller (which already
+    # validated the whole batch) passes the size in.
+    if source_size is None:
+        st = _stat_regular_file(source_p)
+        if st is None:
+            raise ValueError(f"copy_file_deduplicated failed: source file is not a file or does not exist: {source_p}")
+        source_size = st.st_size
 
-    size = os.path.getsize(source_p)
+    dest_dir, dest_n = os.path.split(dest_p)  # computed once, used several times below
 
-    # Check to see if there are any files of that size in the .data dir
-    try:
-        possible_matches_p = data_sizes[size]
-    except KeyError:
-        possible_matches_p = []
+    size = source_size
+
+    # Check to see if there are any files of that size in the .data dir. Using .get avoids raising and catching a
+    # KeyError per file in what is a very hot loop (the empty tuple default is a singleton, so no allocation either).
+    possible_matches_p = data_sizes.get(size, ())
 
     matched_p = None
 
-    # If there are possible matches, try to find an actual match by comparing md5 checksums
+    # If there are possible matches, try to find an actual match by comparing hashes. Compare cheap head hashes first
+    # (files whose first 64 KB differ cannot match), and only fall through to a full-file hash on a head hash match.
+    # Files no bigger than the head size skip the head stage since their head hash would read the whole file anyway.
     if possible_matches_p:
-        source_md5 = md5_for_file(source_p)
-        for possible_match_p in possible_matches_p:
 
-            try:  # Try to get the md5 from the cached hashes first
-                possible_match_md5 = cached_md5[possible_match_p]
-            except KeyError:  # We don't have a cached md5 for this possible match, so create it and cache it
-                possible_match_md5 = md5_for_file(possible_match_p)
-                cached_md5[possible_match_p] = possible_match_md5  # cache this md5
+        if cached_head is None:
+            cached_head = dict()
 
-            if source_md5 == possible_match_md5:
-                matched_p = possible_match_p
-                break
+        source_hash = cached_hash.get(source_p)
+
+        # O(1) path: if the source's full hash is already known, a digest-keyed lookup finds a duplicate immediately
+        # without touching the candidate list at all.
+        if by_digest is not None and source_hash is not None:
+            matched_p = by_digest.get(source_hash)
+
+        # Incremental ingest usually produces a size bucket with exactly one candidate. When neither side's full hash
+        # is cached, settle that single candidate with a direct byte comparison: it stops at the first differing
+        # block, where hashing would read both files in full, and leaves nothing useful uncached (a digest of either
+        # side would only ever be compared against the other).
+        if (matched_p is None
+                and len(possible_matches_p) == 1
+                and source_hash is None
+                and cached_hash.get(possible_matches_p[0]) is None):
+            if _byte_equal(source_p, possible_matches_p[0]):
+                matched_p = possible_matches_p[0]
+            possible_matches_p = ()
+
+        if matched_p is None and possible_matches_p:
+            use_head_hash = size > _HEAD_HASH_SIZE
+            source_head = _get_cached_hash(cached_head, source_p, _head_hash) if use_head_hash else None
+
+            for possible_match_p in possible_matches_p:
+
+                if use_head_hash:
+                    if _get_cached_hash(cached_head, possible_match_p, _head_hash) != source_head:
+                        continue
+
+                if source_hash is None:
+                    source_hash = _get_cached_hash(cached_hash, source_p, content_hash_for_file)
+
+                if source_hash == _get_cached_hash(cached_hash, possible_match_p, content_hash_for_file):
+                    matched_p = possible_match_p
+                    break
+
+        if by_digest is not None and matched_p is not None and source_hash is not None:
+            by_digest[source_hash] = matched_p
 
     # If we did not find a matching file, then copy the file to the data_d dir (this will add a version number that
     # ensures that we do not overwrite any previous versions of files with the same name).
     if matched_p is None:
-        dest_n = os.path.split(dest_p)[1]
+        base, ext = os.path.splitext(dest_n)
+        start_v = 1 if next_ver is None else next_ver.get((base, ext), 1)
         data_file_p = copy_and_add_ver_num(source_p=source_p,
                                            dest_p=os.path.join(data_d, dest_n),
                                            ver_prefix=ver_prefix,
                                            num_digits=num_digits,
-                                           do_verified_copy=do_verified_copy)
+                                           do_verified_copy=do_verified_copy,
+                                           src_digest=cached_hash.get(source_p),
+                                           start_v=start_v,
+                                           allow_hardlink=allow_hardlink)
+        if next_ver is not None:
+            data_file_n = os.path.basename(data_file_p)
+            used_v = int(data_file_n[len(base) + 1 + len(ver_prefix):len(data_file_n) - len(ext)])
+            next_ver[(base, ext)] = used_v + 1
+        if by_digest is not None:
+            digest = cached_hash.get(source_p)
+            if digest is not None:
+                by_digest[digest] = data_file_p
     else:
         data_file_p = matched_p
 
     # Create the directories where the symlink will be stored.
-    os.makedirs(os.path.split(dest_p)[0], exist_ok=True)
+    os.makedirs(dest_dir, exist_ok=True)
 
     # Build a relative path from dest_p to the file the file we just copied into the data dir. Then create a symlink to
     # this file in the destination.
-    relative_p = os.path.relpath(data_file_p, os.path.split(dest_p)[0])
+    relative_p = os.path.relpath(data_file_p, dest_dir)
 
-    if os.path.exists(dest_p):
-        os.unlink(dest_p)
-    os.symlink(relative_p, dest_p)
+    _atomic_symlink(relative_p, dest_p)
 
     # update the data_sizes dictionary (for performance in case we are running this function inside a loop)
     bvzfilesystemlib.add_file_to_dict_by_size(data_file_p, data_sizes)
@@ -1,4 +1,4 @@
-import os.path
+import itertools
 from dataclasses import dataclass
 
 """
@@ -7,24 +7,39 @@ A basic class to hold the info about a single file that is to be copied using de
 
 
 # ======================================================================================================================
+@dataclass(frozen=True, slots=True)
 class Copydescriptor:
+    """
+    The data about a single file to be copied: where it comes from, where (relative to the destination root) it should
+    appear, and whether it should be linked in place instead of copied. Construction does no disk access - sources are
+    validated in a single batched pass by copy_files_deduplicated, so building descriptors for very large file lists
+    costs no stat calls.
+    """
+
+    source_p: str
+    dest_relative_p: str
+    link_in_place: bool = False
 
     # ------------------------------------------------------------------------------------------------------------------
-    def __init__(self,
-                 source_p,
-                 dest_relative_p,
-                 link_in_place=False):
-        """
-        Initialize the object with the data about the file to be copied.
+    @classmethod
+    def from_paths(cls,
+                   sources,
+                   rel_paths,
+                   link_in_place=False):
         """
+        Build a list of copydescriptors from parallel lists of source paths and relative destination paths. The whole
+        list is constructed by a single C-level map call, which is faster than a Python-level loop of constructor
+        calls when descriptor lists run to many thousands of files.
 
-        assert type(source_p) is str
-        assert type(dest_relative_p) is str
-        assert type(link_in_place) is bool
+        :param sources:
+                A list of full paths to the source files.
+        :param rel_paths:
+                A list, parallel to sources, of the relative destination paths.
+        :param link_in_place:
+                If True, then each file will be set to link in place. Applied to every descriptor. Defaults to False.
 
-        if not os.path.exists(source_p):
-            raise ValueError(f"Source file {source_p} does not exist.")
+        :return:
+                A list of copydescriptor objects.
+        """
 
-        self.source_p = source_p
-        self.dest_relative_p = dest_relative_p
-        self.link_in_place=link_in_place
+        return list(map(cls, sources, rel_paths, itertools.repeat(link_in_place)))
@@ -0,0 +1,282 @@
+import json
+import os
+
+"""
+A basic class to hold a persistent index of the files stored in a data directory, so that repeated de-duplication runs
+do not have to re-scan and re-hash files that have not changed.
+"""
+
+# The name of the index file stored inside the data directory.
+INDEX_FILE_N = ".bvz_index.json"
+
+
+# ======================================================================================================================
+class DedupIndex:
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def __init__(self,
+                 data_d,
+                 algorithm):
+        """
+        Initialize the index for the given data directory, loading any previously saved index file. An index saved with
+        a different hashing algorithm is discarded (the stored digests would be meaningless).
+
+        :param data_d:
+                The data directory this index describes.
+        :param algorithm:
+                The name of the hashing algorithm whose digests are stored in this index.
+        """
+
+        assert type(data_d) is str
+        assert type(algorithm) is str
+
+        self.data_d = data_d.rstrip(os.sep)
+        self.algorithm = algorithm
+        self.index_p = os.path.join(self.data_d, INDEX_FILE_N)
+
+        # file path -> {"size": int, "mtime_ns": int, "digest": hex str or None, "head": hex str or None}
+        self._entries = dict()
+        self._dirty = False
+
+        # The mtime of the data directory itself as of the last refresh. Lets a refresh become a no-op when nothing
+        # in the directory has changed since then.
+        self._refreshed_mtime_ns = None
+
+        self._load()
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def _load(self):
+        """
+        Load the saved index file, if there is one. Corrupt or incompatible index files are silently discarded (the
+        index is just a cache - everything in it can be recomputed).
+
+        :return:
+                Nothing.
+        """
+
+        try:
+            with open(self.index_p, "r") as f:
+                raw = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if not isinstance(raw, dict) or raw.get("algorithm") != self.algorithm:
+            return
+
+        entries = raw.get("entries")
+        if not isinstance(entries, dict):
+            return
+
+        for file_p, entry in entries.items():
+            try:
+                self._entries[file_p] = {"size": int(entry["size"]),
+                                         "mtime_ns": int(entry["mtime_ns"]),
+                                         "ino": int(entry.get("ino", 0)),
+                                         "digest": entry.get("digest"),
+                                         "head": entry.get("head")}
+            except (TypeError, KeyError, ValueError):
+                continue
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def refresh(self):
+        """
+        Reconcile the index with the current contents of the data directory. Files are discovered with a single
+        os.scandir pass. Entries whose (size, mtime_ns) still match the file on disk keep their cached digests; entries
+        for files that changed or disappeared are invalidated. If the data directory's own mtime is unchanged since the
+        last refresh in this process, the scan is skipped entirely (a directory's mtime changes whenever a file is
+        added, removed or renamed in it).
+
+        :return:
+                Nothing.
+        """
+
+        try:
+            dir_mtime_ns = os.stat(self.data_d).st_mtime_ns
+        except FileNotFoundError:
+            self._entries = dict()
+            self._refreshed_mtime_ns = None
+            return
+
+        if dir_mtime_ns == self._refreshed_mtime_ns:
+            return
+
+        found = dict()
+
+        try:
+            scan = os.scandir(self.data_d)
+        except FileNotFoundError:
+            self._entries = dict()
+            self._refreshed_mtime_ns = None
+            return
+
+        with scan:
+            for dir_entry in scan:
+
+                if dir_entry.name == INDEX_FILE_N or not dir_entry.is_file(follow_symlinks=False):
+                    continue
+
+                st = dir_entry.stat(follow_symlinks=False)
+                entry = self._entries.get(dir_entry.path)
+
+                # An entry is stale if its size or mtime changed, or if the path now points at a different inode (a
+                # file swapped in via rename can keep the old size and mtime). An inode of 0 means an older index
+                # that did not record inodes - accept it rather than invalidating the whole cache.
+                if (entry is None
+                        or entry["size"] != st.st_size
+                        or entry["mtime_ns"] != st.st_mtime_ns
+                        or entry["ino"] not in (0, st.st_ino)):
+                    entry = {"size": st.st_size,
+                             "mtime_ns": st.st_mtime_ns,
+                             "ino": st.st_ino,
+                             "digest": None,
+                             "head": None}
+                    self._dirty = True
+                else:
+                    entry["ino"] = st.st_ino
+
+                found[dir_entry.path] = entry
+
+        if found.keys() != self._entries.keys():
+            self._dirty = True
+
+        self._entries = found
+        self._refreshed_mtime_ns = dir_mtime_ns
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def sizes(self):
+        """
+        Build a dictionary of the indexed files keyed by file size. Each size bucket is sorted by inode number so
+        that a caller reading through a bucket opens the files in roughly on-disk order, which keeps the reads closer
+        to sequential than insertion order would.
+
+        :return:
+                A dictionary where the key is a file size, and the value is a list of indexed file paths of that size.
+        """
+
+        output = dict()
+
+        for file_p, entry in self._entries.items():
+            output.setdefault(entry["size"], list()).append((entry["ino"], file_p))
+
+        return {size: [file_p for _ino, file_p in sorted(bucket)] for size, bucket in output.items()}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def digests(self):
+        """
+        Build a dictionary of the cached full-file digests.
+
+        :return:
+                A dictionary where the key is an indexed file path, and the value is its digest as bytes. Files whose
+                digest has not been computed yet are omitted.
+        """
+
+        return {file_p: bytes.fromhex(entry["digest"])
+                for file_p, entry in self._entries.items()
+                if entry["digest"] is not None}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def digest_paths(self):
+        """
+        Build a reverse mapping of the cached full-file digests, so a caller holding a digest can find a matching data
+        file in O(1) instead of hashing its way through a list of same-size candidates.
+
+        :return:
+                A dictionary where the key is a digest as bytes, and the value is an indexed file path with that
+                digest. Files whose digest has not been computed yet are omitted.
+        """
+
+        return {bytes.fromhex(entry["digest"]): file_p
+                for file_p, entry in self._entries.items()
+                if entry["digest"] is not None}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def head_digests(self):
+        """
+        Build a dictionary of the cached head digests (digests of only the first portion of each file).
+
+        :return:
+                A dictionary where the key is an indexed file path, and the value is its head digest as bytes. Files
+                whose head digest has not been computed yet are omitted.
+        """
+
+        return {file_p: bytes.fromhex(entry["head"])
+                for file_p, entry in self._entries.items()
+                if entry["head"] is not None}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def add_file(self,
+                 file_p,
+                 digest=None):
+        """
+        Add (or update) the index entry for a single file that was just written to the data directory.
+
+        :param file_p:
+                The path to the file being added.
+        :param digest:
+                The full-file digest of the file, if it is already known. Defaults to None.
+
+        :return:
+                Nothing.
+        """
+
+        st = os.stat(file_p)
+        entry = self._entries.get(file_p)
+
+        # If the file is already indexed and unchanged, just fill in the digest if we can.
+        if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            if digest is not None and entry["digest"] is None:
+                entry["digest"] = digest.hex()
+                self._dirty = True
+            return
+
+        self._entries[file_p] = {"size": st.st_size,
+                                 "mtime_ns": st.st_mtime_ns,
+                                 "ino": st.st_ino,
+                                 "digest": digest.hex() if digest is not None else None,
+                                 "head": None}
+        self._dirty = True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def update_from_caches(self,
+                           cached_digests,
+                           cached_heads):
+        """
+        Store any digests that were computed during a dedup run for files that live in the data directory. Digests for
+        files outside the data directory (i.e. source files) are ignored.
+
+        :param cached_digests:
+                A dictionary of full-file digests keyed on file path.
+        :param cached_heads:
+                A dictionary of head digests keyed on file path.
+
+        :return:
+                Nothing.
+        """
+
+        for key, cache in (("digest", cached_digests), ("head", cached_heads)):
+            for file_p, digest in cache.items():
+                entry = self._entries.get(file_p)
+                if entry is not None and entry[key] is None:
+                    entry[key] = digest.hex()
+                    self._dirty = True
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def save(self):
+        """
+        Save the index to disk if it has changed. The file is written to a temp name and atomically renamed into
+        place, so a concurrent reader never sees a half-written index.
+
+        :return:
+                Nothing.
+        """
+
+        if not self._dirty:
+            return
+
+        temp_p = self.index_p + f".tmp.{os.getpid()}"
+
+        with open(temp_p, "w") as f:
+            json.dump({"algorithm": self.algorithm, "entries": self._entries}, f)
+
+        os.replace(temp_p, self.index_p)
+        self._dirty = False